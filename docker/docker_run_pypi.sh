@@ -26,7 +26,7 @@ set -e -u -x
 # Install packages and test; note that Python 3.10 is excluded here
 # because nosetest is not properly working
 for PYBIN in /opt/python/cp3[7,8,9]*/bin; do
-    "${PYBIN}/python" -m pip install numpy nose
+    "${PYBIN}/python" -m pip install numpy scipy nose
     "${PYBIN}/pip" install pyqint --no-index -f /io/wheelhouse
     (cd "$HOME"; "${PYBIN}/nosetests" --verbose /io/tests/*.py)
 done
\ No newline at end of file
@@ -4,8 +4,10 @@ import json
 import os
 from .cgf import cgf
 import numpy as np
+import scipy.linalg
 from . import PyQInt
 import time
+from multiprocessing import Pool
 
 # couple of hardcoded variables for the DIIS algorithm
 SUBSPACE_LENGTH = 4
@@ -32,6 +34,7 @@ class HF:
         # build cgfs, nuclei and calculate nr of electrons
         cgfs, nuclei = mol.build_basis(basis)
         nelec = int(np.sum([at[1] for at in nuclei]))
+        nocc = nelec // 2
 
         # build integrals
         integrator = PyQInt()
@@ -40,24 +43,49 @@ class HF:
         end = time.time()
         time_stats['integral_evaluation'] = end - start
 
+        # unpack two-electron integrals into a rank-4 tensor (ij|kl) and
+        # fold the Coulomb (ij|lk) and exchange (ik|lj) contributions into
+        # a single matrix such that G[i,j] = sum_kl gmat[ij,kl] * P[k,l]
+        n = len(cgfs)
+        eri = self.build_eri_tensor(teint, n)
+        gmat = (eri.transpose(0,1,3,2) - 0.5 * eri.transpose(0,3,1,2)).reshape(n*n, n*n)
+
         # diagonalize S
-        s, U = np.linalg.eigh(S)
+        s, U = scipy.linalg.eigh(S, driver='evd')
 
-        # construct transformation matrix X
+        # construct canonical orthogonalization matrix X; the SCF cycle
+        # solves the generalized eigenvalue problem directly, but X is
+        # still reported as part of the solution
         X = U.dot(np.diag(1.0/np.sqrt(s)))
 
-        # create empty P matrix as initial guess
+        # calculate repulsion of the nuclei; this term does not change
+        # during the self-consistent field iterations
+        R = np.array([nucleus[0] for nucleus in nuclei])
+        Z = np.array([nucleus[1] for nucleus in nuclei])
+        D = np.linalg.norm(R[:,None] - R[None,:], axis=-1)
+        np.fill_diagonal(D, np.inf)
+        enuc = 0.5 * np.sum(np.outer(Z, Z) / D)
+
+        # core Hamiltonian
+        Hcore = T + V
+
+        # create empty P matrix as initial guess; P and G are updated in
+        # place during the iterations to avoid reallocating them
         P = np.zeros(S.shape)
+        G = np.empty(S.shape)
 
         # keep track of time
         start = time.time()
 
-        # build containers to store per-iteration data
+        # build containers to store per-iteration data; the Fock matrices
+        # and error vectors of the last SUBSPACE_LENGTH iterations are kept
+        # in ring buffers for the DIIS algorithm
         energies = []
         time_stats['iterations'] = []
-        fmats_diis = []
-        pmat_diis = []
-        evs_diis = []
+        fmats_diis = np.empty((SUBSPACE_LENGTH, n, n))
+        evs_diis = np.empty((SUBSPACE_LENGTH, n*n))
+        head = 0    # slot that receives the next entry
+        count = 0   # number of filled slots
 
         # start iterations
         for niter in range(0,itermax):
@@ -65,52 +93,29 @@ class HF:
             iterstart = time.time()
 
             if niter > SUBSPACE_START and use_diis:
-                diis_coeff = self.calculate_diis_coefficients(evs_diis)
-
-                F = self.extrapolate_fock_from_diis_coefficients(fmats_diis, diis_coeff)
-                Fprime = X.transpose().dot(F).dot(X)
-                e, Cprime = np.linalg.eigh(Fprime)
-                C = X.dot(Cprime)
-                P = np.zeros(S.shape)
-                for i in range(S.shape[0]):
-                    for j in range(S.shape[0]):
-                        for k in range(0,int(nelec/2)):
-                            P[i,j] += 2.0 * C[i,k] * C[j,k]
+                diis_coeff = self.calculate_diis_coefficients(evs_diis[:count])
+
+                F = self.extrapolate_fock_from_diis_coefficients(fmats_diis[:count], diis_coeff)
+                e, C = scipy.linalg.eigh(F, S, driver='gvd')
+                Cocc = C[:,:nocc]
+                np.dot(Cocc, Cocc.T, out=P)
+                P *= 2.0
 
             # calculate G
-            G = np.zeros(S.shape)
-            for i in range(S.shape[0]):
-                for j in range(S.shape[0]):
-                    for k in range(S.shape[0]):
-                        for l in range(S.shape[0]):
-                            idx_rep = integrator.teindex(i,j,l,k)
-                            idx_exc = integrator.teindex(i,k,l,j)
-                            G[i,j] += P[k,l] * (teint[idx_rep] - 0.5 * teint[idx_exc])
+            np.dot(gmat, P.ravel(), out=G.ravel())
 
             # build Fock matrix
-            F = T + V + G
-
-            # transform Fock matrix
-            Fprime = X.transpose().dot(F).dot(X)
-
-            # diagonalize F
-            orbe, Cprime = np.linalg.eigh(Fprime)
+            F = Hcore + G
 
-            # back-transform
-            C = X.dot(Cprime)
+            # solve the generalized eigenvalue problem FC = SCe
+            orbe, C = scipy.linalg.eigh(F, S, driver='gvd')
 
             # calculate energy E
-            energy = 0.0
-            M = T + V + F
-            for i in range(S.shape[0]):
-                for j in range(S.shape[0]):
-                    energy += 0.5 * P[j,i] * M[i,j]
-
-            # calculate repulsion of the nuclei
-            for i in range(0, len(nuclei)):
-                for j in range(i+1, len(nuclei)):
-                    r = np.linalg.norm(np.array(nuclei[i][0]) - np.array(nuclei[j][0]))
-                    energy += nuclei[i][1] * nuclei[j][1] / r
+            M = Hcore + F
+            energy = float(0.5 * np.tensordot(P, M, axes=([0,1],[1,0])))
+
+            # add repulsion of the nuclei
+            energy += enuc
 
             # store energy for next iteration
             energies.append(energy)
@@ -119,27 +124,18 @@ class HF:
             # matrix from the coefficients, else, resort to the DIIS
             # algorithm
             if niter <= SUBSPACE_START or not use_diis:
-                Pold = P.copy()
-                P = np.zeros(S.shape)
-                for i in range(S.shape[0]):
-                    for j in range(S.shape[0]):
-                        for k in range(0,int(nelec/2)):
-                            P[i,j] += 2.0 * C[i,k] * C[j,k]
+                Cocc = C[:,:nocc]
+                np.dot(Cocc, Cocc.T, out=P)
+                P *= 2.0
 
             # calculate DIIS coefficients
-            e = (F.dot(P.dot(S)) - S.dot(P.dot(F))).flatten()   # calculate error vector
+            FPS = F @ (P @ S)                                   # SPF equals (FPS)^T for symmetric F, P, S
+            e = (FPS - FPS.T).ravel()                           # calculate error vector
             enorm = np.linalg.norm(e)                           # store error vector norm
-            fmats_diis.append(F)                                # add Fock matrix to list
-            pmat_diis.append(P)                                 # add density matrix to list
-            evs_diis.append(e)
-
-            # prune size of the old Fock, density and error vector lists
-            # only SUBSPACE_LENGTH iterations are used to guess the new
-            # solution
-            if len(fmats_diis) > SUBSPACE_LENGTH:
-                fmats_diis = fmats_diis[-SUBSPACE_LENGTH:]
-                pmat_diis = pmat_diis[-SUBSPACE_LENGTH:]
-                evs_diis = evs_diis[-SUBSPACE_LENGTH:]
+            fmats_diis[head] = F                                # add Fock matrix to buffer
+            evs_diis[head] = e                                  # add error vector to buffer
+            head = (head + 1) % SUBSPACE_LENGTH
+            count = min(count + 1, SUBSPACE_LENGTH)
 
             # store iteration time
             iterend = time.time()
@@ -183,49 +179,78 @@ class HF:
             "overlap": S,
             "kinetic": T,
             "nuclear": V,
-            'hcore': T+V,
+            'hcore': Hcore,
             "time_stats" : time_stats,
-            "ecore": np.sum(P * (T + V)),
+            "ecore": float(np.einsum('ij,ij->', P, Hcore)),
             "teint": teint,
             "forces": self.rhf_forces(mol, basis, C, P, orbe) if calc_forces else None
         }
 
         return sol
 
-    def calculate_diis_coefficients(self, evs_diis):
+    def build_eri_tensor(self, teint, n):
         """
-        Calculate the DIIS coefficients
+        Unpack the list of unique two-electron integrals into a rank-4
+        tensor eri[i,j,k,l] = (ij|kl)
+
+        The position of each integral in teint is resolved using the
+        same canonical ordering as PyQInt.teindex, evaluated for all
+        quartets at once
+
+        teint:          list of unique two-electron integrals
+        n:              number of basis functions
         """
-        B = np.zeros((len(evs_diis)+1, len(evs_diis)+1))
-        B[-1,:] = -1
-        B[:,-1] = -1
-        B[-1,-1]=  0
+        idx = np.arange(n)
+        hi = np.maximum.outer(idx, idx)
+        pair = hi * (hi + 1) // 2 + np.minimum.outer(idx, idx)
 
-        rhs = np.zeros((len(evs_diis)+1, 1))
-        rhs[-1,-1] = -1
+        ij = pair[:,:,None,None]
+        kl = pair[None,None,:,:]
+        hi = np.maximum(ij, kl)
+        index = hi * (hi + 1) // 2 + np.minimum(ij, kl)
 
-        for i in range(len(evs_diis)):
-            for j in range(i+1):
-                B[i,j] = np.dot(evs_diis[i].transpose(), evs_diis[j])
-                B[j,i] = B[i,j]
+        return np.asarray(teint)[index]
 
-        *diis_coeff, _ = np.linalg.solve(B,rhs)
+    def calculate_diis_coefficients(self, evs_diis):
+        """
+        Calculate the DIIS coefficients
+
+        Rather than solving the bordered Lagrangian system, the unbordered
+        system B c = 1 is solved and the result is normalized such that
+        the coefficients sum to unity. For a non-singular B this yields the
+        same coefficients while avoiding the poor conditioning of the
+        bordered matrix.
 
-        return diis_coeff
+        When the error vectors are linearly dependent (for instance when
+        they all vanish), B is singular and the minimum-norm solution of
+        the bordered system is returned instead.
+        """
+        E = np.asarray(evs_diis)
+        B = E @ E.T
+        m = B.shape[0]
+
+        try:
+            diis_coeff = np.linalg.solve(B, np.ones(m))
+            return diis_coeff / np.sum(diis_coeff)
+        except np.linalg.LinAlgError:
+            A = np.zeros((m+1, m+1))
+            A[:m,:m] = B
+            A[-1,:m] = 1
+            A[:m,-1] = 1
+            rhs = np.zeros(m+1)
+            rhs[-1] = 1
+            return np.linalg.lstsq(A, rhs, rcond=None)[0][:m]
 
     def extrapolate_fock_from_diis_coefficients(self, fmats_diis, diis_coeff):
         """
         Extrapolate the Fock matrix from the DIIS coefficients
         """
-        norbs = fmats_diis[-1].shape[0]
-        fguess = np.zeros((norbs,norbs))
-
-        for i in range(len(fmats_diis)):
-            fguess += fmats_diis[i]*diis_coeff[i]
+        F = np.asarray(fmats_diis)
+        c = np.asarray(diis_coeff).reshape(-1)
 
-        return fguess
+        return np.einsum('i,ijk->jk', c, F)
 
-    def rhf_forces(self, mol, basis, C, P, e):
+    def rhf_forces(self, mol, basis, C, P, e, npar=1):
         """
         Calculate derivatives of nuclear coordinates to obtain forces.
         
@@ -235,76 +260,113 @@ class HF:
         C:      matrix of orbital coefficients
         P:      density matrix
         e:      orbital energies
+        npar:   number of worker processes; with npar=1 all components are
+                evaluated serially in the calling process and with
+                npar=None the number of cpus is used
 
         Returns array of forces with shape [Natoms, 3]
         """
         # intialization
-        integrator = PyQInt()
         cgfs, nuclei = mol.build_basis(basis)
         n_elec = np.sum([nucleus[1] for nucleus in nuclei])
-        forces = np.zeros(shape = [len(mol.atoms), 3])
-        n = len(cgfs)
     
         # calculate energy weighted density matrix:
         # It might be preferrable to recalculate P as well
-        ew_density = np.zeros(shape = [n, n])
-        for i in range(n):
-            for j in range(n):
-                for k in range(0, n_elec//2):
-                    ew_density[i,j] += 2.0 * e[k] * C[i,k] * C[j,k]
-
-        # Loop over all cartesian direction for every nucleus
-        # This could be made more efficient by incorporating symmetry
-        for n_nuc, deriv_nucleus in enumerate(nuclei):            
-            for deriv_direction in range(3): 
-                
-                overlap = np.zeros(shape=[n, n])
-                kinetic = np.zeros(shape=[n, n])
-                nuclear = np.zeros(shape=[n, n])
-                repulsion = np.zeros(shape=[n, n, n, n])
-
-                # Loop over every permutation of cgfs in the basis
-                for i, cgf_1 in enumerate(cgfs):
-                    for j, cgf_2 in enumerate(cgfs):
-
-                        # derivative of overlap matrix
-                        overlap[i, j] += integrator.overlap_deriv(cgf_1, cgf_2, deriv_nucleus[0], deriv_direction)
-
-                        # derivative of kinetic matrix
-                        kinetic[i, j] += integrator.kinetic_deriv(cgf_1, cgf_2, deriv_nucleus[0], deriv_direction)
-                        
-                        # derivative nuclear electron attraction
-                        for nucleus in mol.nuclei:
-                            
-                            # nuclear_deriv_op returns wrong values if both cgfs and nucleus is on deriv_nucleus
-                            # the following if statment eliminates that term using translational symmetry 
-                            if not (np.linalg.norm(cgf_1.p - deriv_nucleus[0]) < 0.0001 and  np.linalg.norm(cgf_2.p - deriv_nucleus[0]) < 0.0001 and np.linalg.norm(nucleus[0] - deriv_nucleus[0]) < 0.0001):
-                                nuclear[i, j] += integrator.nuclear_deriv(cgf_1, cgf_2, nucleus[0], nucleus[1], deriv_nucleus[0], deriv_direction)
-
-                        # derivative of electron-electron repulsions
-                        for k, cgf_3 in enumerate(cgfs):
-                            for l, cgf_4 in enumerate(cgfs):
-                                repulsion[i, j, k, l] += integrator.repulsion_deriv(cgf_1, cgf_2, cgf_3, cgf_4, deriv_nucleus[0], deriv_direction)
-                        
-                # derivate nucleus-nucleus repulsion
-                term_nn = 0
-                for nucleus in nuclei:
-                    if np.linalg.norm(nucleus[0] - deriv_nucleus[0]) > 0.0001:
-                        term_nn += deriv_nucleus[1] * nucleus[1] * (nucleus[0][deriv_direction] - deriv_nucleus[0][deriv_direction]) / (np.linalg.norm(nucleus[0]- deriv_nucleus[0])**3)
-
-                hcore = kinetic + nuclear
-                term_hcore = np.sum(np.multiply(P, hcore))
-
-                term_repulsion = 0
-                for i in range(n):
-                    for j in range(n):
-                        for k in range(n):
-                            for l in range(n):
-                                term_repulsion += 1/2 * P[i, j] * P[k, l]*(repulsion[i, j, k, l] - 1/2*repulsion[i, k, j, l]) 
-                
-                term_overlap = - np.sum(np.multiply(ew_density, overlap))
-           
-                # F = - d/dR E
-                forces[n_nuc, deriv_direction] -= term_hcore + term_repulsion + term_overlap + term_nn 
+        nocc = int(n_elec) // 2
+        Cocc = C[:,:nocc]
+        ew_density = (Cocc * (2.0 * e[:nocc])) @ Cocc.T
+
+        # positions and charges that are invariant over all jobs
+        nuc_pos = np.array([nucleus[0] for nucleus in nuclei])
+        nuc_Z = np.array([nucleus[1] for nucleus in nuclei])
+        cgf_pos = np.array([cgf.p for cgf in cgfs])
+
+        # every cartesian direction of every nucleus is independent of the
+        # others and is evaluated as a separate job
+        jobs = [(cgfs, nuclei, nuc_pos, nuc_Z, cgf_pos, P, ew_density, n_nuc, deriv_direction)
+                for n_nuc in range(len(nuclei))
+                for deriv_direction in range(3)]
+
+        if npar == 1:
+            derivs = [_force_component(*job) for job in jobs]
+        else:
+            with Pool(min(npar or os.cpu_count(), len(jobs))) as p:
+                derivs = p.starmap(_force_component, jobs)
+
+        # F = - d/dR E
+        forces = -np.array(derivs).reshape(len(mol.atoms), 3)
 
         return forces
+
+def _force_component(cgfs, nuclei, nuc_pos, nuc_Z, cgf_pos, P, ew_density, n_nuc, deriv_direction):
+    """
+    Calculate the derivative of the total energy with respect to a single
+    cartesian coordinate of a nucleus
+
+    cgfs:               list of contracted Gaussian functions
+    nuclei:             list of nuclei
+    nuc_pos:            array of nuclear positions
+    nuc_Z:              array of nuclear charges
+    cgf_pos:            array of cgf centers
+    P:                  density matrix
+    ew_density:         energy weighted density matrix
+    n_nuc:              index of the nucleus being displaced
+    deriv_direction:    cartesian direction of the displacement
+    """
+    integrator = PyQInt()
+    deriv_nucleus = nuclei[n_nuc]
+    n = len(cgfs)
+
+    # flag the cgfs and nuclei that reside on the nucleus that
+    # is being displaced
+    cgf_on = np.linalg.norm(cgf_pos - deriv_nucleus[0], axis=1) < 0.0001
+    nuc_on = np.linalg.norm(nuc_pos - deriv_nucleus[0], axis=1) < 0.0001
+
+    # nuclear_deriv_op returns wrong values if both cgfs and nucleus is on deriv_nucleus;
+    # these terms are eliminated using translational symmetry
+    skip_mask = cgf_on[:,None,None] & cgf_on[None,:,None] & nuc_on[None,None,:]
+
+    overlap = np.zeros(shape=[n, n])
+    kinetic = np.zeros(shape=[n, n])
+    nuclear = np.zeros(shape=[n, n])
+    repulsion = np.zeros(shape=[n, n, n, n])
+
+    # Loop over every permutation of cgfs in the basis
+    for i, cgf_1 in enumerate(cgfs):
+        for j, cgf_2 in enumerate(cgfs):
+
+            # derivative of overlap matrix
+            overlap[i, j] += integrator.overlap_deriv(cgf_1, cgf_2, deriv_nucleus[0], deriv_direction)
+
+            # derivative of kinetic matrix
+            kinetic[i, j] += integrator.kinetic_deriv(cgf_1, cgf_2, deriv_nucleus[0], deriv_direction)
+            
+            # derivative nuclear electron attraction
+            for k, nucleus in enumerate(nuclei):
+                if not skip_mask[i,j,k]:
+                    nuclear[i, j] += integrator.nuclear_deriv(cgf_1, cgf_2, nucleus[0], nucleus[1], deriv_nucleus[0], deriv_direction)
+
+    # derivative of electron-electron repulsions; the derivatives
+    # are symmetric upon swapping i <-> j and k <-> l, such that
+    # only the unique pairs need to be evaluated
+    for i, cgf_1 in enumerate(cgfs):
+        for j, cgf_2 in enumerate(cgfs[:i+1]):
+            for k, cgf_3 in enumerate(cgfs):
+                for l, cgf_4 in enumerate(cgfs[:k+1]):
+                    val = integrator.repulsion_deriv(cgf_1, cgf_2, cgf_3, cgf_4, deriv_nucleus[0], deriv_direction)
+                    repulsion[i, j, k, l] = repulsion[j, i, k, l] = val
+                    repulsion[i, j, l, k] = repulsion[j, i, l, k] = val
+
+    # derivate nucleus-nucleus repulsion
+    dR = nuc_pos[~nuc_on] - deriv_nucleus[0]
+    term_nn = deriv_nucleus[1] * np.sum(nuc_Z[~nuc_on] * dR[:,deriv_direction] / np.linalg.norm(dR, axis=1)**3)
+
+    hcore = kinetic + nuclear
+    term_hcore = float(P.ravel() @ hcore.ravel())
+
+    term_repulsion = 0.5 * np.einsum('ij,kl,ijkl->', P, P, repulsion, optimize='greedy') - \
+                     0.25 * np.einsum('ij,kl,ikjl->', P, P, repulsion, optimize='greedy')
+    
+    term_overlap = - float(ew_density.ravel() @ overlap.ravel())
+
+    return term_hcore + term_repulsion + term_overlap + term_nn
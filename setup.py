@@ -105,5 +105,5 @@ setup(
         "Operating System :: POSIX",
     ],
     python_requires='>=3.5',
-    install_requires=['numpy'],
+    install_requires=['numpy', 'scipy>=1.5'],
 )
@@ -54,6 +54,57 @@ class TestHF(unittest.TestCase):
         en = -39.35007843284954
         np.testing.assert_almost_equal(results['energies'][-1], en, 4)
 
+    def testDIISCoefficients(self):
+        """
+        Test that the DIIS coefficients match those of the bordered
+        Lagrangian system and sum to unity
+        """
+        np.random.seed(42)
+        evs = [np.random.rand(16) for i in range(4)]
+
+        B = np.zeros((5,5))
+        B[:4,:4] = np.array([[np.dot(a,b) for b in evs] for a in evs])
+        B[-1,:4] = -1
+        B[:4,-1] = -1
+        rhs = np.zeros(5)
+        rhs[-1] = -1
+        ans = np.linalg.solve(B, rhs)[:4]
+
+        coeff = HF().calculate_diis_coefficients(evs)
+        np.testing.assert_almost_equal(coeff, ans)
+        np.testing.assert_almost_equal(np.sum(coeff), 1.0)
+
+    def testDIISCoefficientsVanishingErrors(self):
+        """
+        Test that vanishing error vectors yield equally weighted DIIS
+        coefficients
+        """
+        evs = [np.zeros(16) for i in range(3)]
+        coeff = HF().calculate_diis_coefficients(evs)
+        np.testing.assert_almost_equal(coeff, np.ones(3) / 3.0)
+
+    def testERITensor(self):
+        """
+        Test that the unpacked two-electron integral tensor matches the
+        lookup via teindex
+        """
+        mol = Molecule()
+        mol.add_atom('O', 0.0, 0.0, 0.0)
+        mol.add_atom('H', 0.7570, 0.5860, 0.0)
+        mol.add_atom('H', -0.7570, 0.5860, 0.0)
+
+        cgfs, nuclei = mol.build_basis('sto3g')
+        integrator = PyQInt()
+        S, T, V, teint = integrator.build_integrals_openmp(cgfs, nuclei)
+
+        n = len(cgfs)
+        eri = HF().build_eri_tensor(teint, n)
+        for i in range(n):
+            for j in range(n):
+                for k in range(n):
+                    for l in range(n):
+                        self.assertEqual(eri[i,j,k,l], teint[integrator.teindex(i,j,k,l)])
+
 def perform_hf(mol):
     results = HF().rhf(mol, 'sto3g')
     return results
@@ -34,6 +34,41 @@ class TestHFDeriv(unittest.TestCase):
 
         np.testing.assert_almost_equal(forces, forces_ans)
 
+    def testHartreeFockForcesH2(self):
+        """
+        Test Hartree-Fock forces on H2 using STO-3G basis set against
+        finite difference results
+        """
+        mol = Molecule()
+        mol.add_atom('H', 0.0, 0.0, 0.0)
+        mol.add_atom('H', 0.0, 0.0, 1.4)
+
+        # calculate forces using analytical derivatives
+        solver = HF()
+        res = solver.rhf(mol, 'sto3g', calc_forces=True)
+
+        # calculate forces using finite difference
+        forces = np.zeros((2,3))
+        sz = 0.0001
+        for i in range(0, len(mol.atoms)): # loop over nuclei
+            for j in range(0, 3): # loop over directions
+                mol1 = deepcopy(mol)
+                mol1.atoms[i][1][j] -= sz / 2
+                mol2 = deepcopy(mol)
+                mol2.atoms[i][1][j] += sz / 2
+
+                energy1 = perform_hf(mol1)['energy']
+                energy2 = perform_hf(mol2)['energy']
+
+                forces[i,j] = -(energy2 - energy1) / sz
+
+        np.testing.assert_almost_equal(res['forces'], forces, 4)
+
+        # evaluating the force components in worker processes should
+        # yield the same result as the serial evaluation
+        forces_par = solver.rhf_forces(mol, 'sto3g', res['orbc'], res['density'], res['orbe'], npar=2)
+        np.testing.assert_almost_equal(forces_par, res['forces'])
+
     # def testHartreeFockForces(self):
     #     """
     #     Test Hartree-Fock calculation on water using STO-3G basis set
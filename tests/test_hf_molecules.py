@@ -23,6 +23,22 @@ class TestHFMolecules(unittest.TestCase):
         # check that energy matches
         np.testing.assert_almost_equal(results['energy'], -1.1175059, 5)
     
+    def testH2Compressed(self):
+        """
+        Test Hartree-Fock calculation for a compressed H2 molecule
+
+        The DIIS error vectors vanish for this system, which requires
+        the DIIS coefficients to be solvable for a singular B matrix
+        """
+        mol = Molecule()
+        mol.add_atom('H', 0.0, 0.0, 0.0)
+        mol.add_atom('H', 0.0, 0.0, 0.74)
+
+        results = HF().rhf(mol, 'sto3g')
+
+        # check that energy matches
+        np.testing.assert_almost_equal(results['energy'], -0.8868309716, 5)
+
     def testC2H4(self):
         """
         Test Hartree-Fock calculation for Ethylene